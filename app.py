@@ -1,12 +1,26 @@
 import os
 import re
+import sys
+import subprocess
 import json
+import orjson
+import hashlib
+from decimal import Decimal, InvalidOperation
+from typing_extensions import TypedDict  # pydantic (used by the SDK for response_schema) rejects typing.TypedDict < 3.12
+import tempfile
+import diskcache
+import fitz  # PyMuPDF
 import pdfplumber
+from pdf_workers import extract_page_range
+from token_match import token_set_scores
 import streamlit as st
 import pandas as pd
+import tiktoken
 from dotenv import load_dotenv
 import google.generativeai as genai
-from difflib import SequenceMatcher
+import numpy as np
+from rapidfuzz import fuzz, process
+from scipy.optimize import linear_sum_assignment
 
 # Load .env
 load_dotenv()
@@ -17,35 +31,152 @@ else:
     genai.configure(api_key=GEMINI_KEY)
 
 MODEL_NAME = "gemini-2.5-flash"
+MAX_DOC_TOKENS = 32000  # per document, counted locally
+
+# Build the model client once per server process; module scope itself re-runs on every Streamlit rerun
+@st.cache_resource(show_spinner=False)
+def get_model(model_name=MODEL_NAME):
+    return genai.GenerativeModel(model_name)
+
+_MODEL = get_model() if GEMINI_KEY else None
+
+MAX_DOC_CHARS = 15000  # fallback budget when the tokenizer is unavailable
+
+# Local tokenizer: approximates Gemini's token budget without a count_tokens round-trip.
+# Loaded lazily: tiktoken downloads its BPE file on first use, which must not block startup offline.
+@st.cache_resource(show_spinner=False)
+def get_encoder(name="cl100k_base"):
+    try:
+        return tiktoken.get_encoding(name)
+    except Exception:
+        return None  # cached, so an offline host doesn't retry the download on every rerun
+
+def truncate_tokens(text, limit=MAX_DOC_TOKENS):
+    enc = get_encoder()
+    if enc is None:
+        # No tokenizer (e.g. offline first run): fall back to the original character slice
+        return text[:MAX_DOC_CHARS]
+    tokens = enc.encode(text, disallowed_special=())
+    if len(tokens) <= limit:
+        return text
+    return enc.decode(tokens[:limit])
+
+# On-disk cache for PDF text and Gemini parses, keyed by content hash.
+# cache_resource keeps one SQLite handle per server process instead of reopening it on every rerun.
+@st.cache_resource(show_spinner=False)
+def get_disk_cache(path="./.cache"):
+    return diskcache.Cache(path)
+
+cache = get_disk_cache()
+
+CACHE_TTL_SECONDS = 30 * 24 * 3600  # entries expire even if nothing changed
+
+# Bump whenever extraction output changes (library, page selection, joining) so old text isn't served
+EXTRACTOR_VERSION = 2
+
+def content_hash(data):
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
 
 st.set_page_config(page_title="PO vs Invoice Comparator", layout="wide")
 
 st.title("📄 PO vs Invoice Comparator (Streamlit + Gemini)")
 
+# ---- Helper: extract text with pdfplumber (slower fallback, parallel over pages for long PDFs) ----
+PARALLEL_MIN_PAGES = 16   # below this, worker startup costs more than it saves
+MIN_PAGES_PER_WORKER = 8  # each worker re-parses the xref, so give it a real share of pages
+PDF_HELPER_TIMEOUT_SECONDS = 120  # a pathological PDF must not block the session forever
+_PDF_WORKERS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pdf_workers.py")
+
+def extract_text_with_pdfplumber(file_bytes, max_pages=None):
+    path = None
+    try:
+        # Workers open the PDF by path, so spill the upload to a temp file
+        with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as tmp:
+            tmp.write(file_bytes)
+            path = tmp.name
+        with pdfplumber.open(path) as pdf:
+            n_pages = len(pdf.pages)
+        if max_pages:
+            n_pages = min(n_pages, max_pages)
+
+        workers = min(os.cpu_count() or 1, n_pages // MIN_PAGES_PER_WORKER)
+        if n_pages < PARALLEL_MIN_PAGES or workers < 2:
+            return extract_page_range(path, 1, n_pages + 1)
+        # Run the spawn pool from a helper process, never from the Streamlit server itself (see pdf_workers)
+        try:
+            result = subprocess.run(
+                [sys.executable, _PDF_WORKERS, path, str(n_pages), str(workers)],
+                capture_output=True, encoding="utf-8", check=True, timeout=PDF_HELPER_TIMEOUT_SECONDS,
+            )
+        except subprocess.CalledProcessError as e:
+            # Surface the helper's own error (last traceback line), not the command line with the temp path
+            lines = (e.stderr or "").strip().splitlines()
+            raise RuntimeError(lines[-1] if lines else f"PDF worker exited with status {e.returncode}") from None
+        except subprocess.TimeoutExpired:
+            raise RuntimeError(f"PDF text extraction timed out after {PDF_HELPER_TIMEOUT_SECONDS}s") from None
+        return result.stdout
+    finally:
+        if path:
+            os.unlink(path)
+
 # ---- Helper: extract text from PDF pages ----
-def extract_text_from_pdf(file_obj):
-    """Return extracted text from all pages of uploaded PDF (file-like object)."""
+@st.cache_data(show_spinner=False, max_entries=32)
+def extract_text_from_pdf(file_bytes: bytes, max_pages: int | None = None) -> str:
+    """Return text of the first max_pages pages (None = all) of an uploaded PDF, passed as bytes so Streamlit can hash it."""
+    key = ("pdf_text", EXTRACTOR_VERSION, content_hash(file_bytes), max_pages)
+    cached = cache.get(key)  # single lookup: an entry can expire between `in` and `[]`
+    if cached is not None:
+        return cached
+
+    # PyMuPDF first: plain text only, far faster than pdfminer-based parsing
+    text = ""
+    try:
+        with fitz.open(stream=file_bytes, filetype="pdf") as doc:
+            stop = min(len(doc), max_pages) if max_pages else len(doc)
+            text = "\n\n".join(page.get_text("text") for page in doc.pages(0, stop)).strip()
+    except Exception:
+        text = ""
+
+    if not text:
+        # Let failures raise: st.cache_data would otherwise memoize "" for this upload process-wide
+        text = extract_text_with_pdfplumber(file_bytes, max_pages).strip()
+
+    cache.set(key, text, expire=CACHE_TTL_SECONDS)
+    return text
+
+def read_uploaded_pdf(uploaded_file, max_pages=None):
+    """Extract text from an uploaded PDF, reporting read failures in the UI instead of caching them."""
     try:
-        with pdfplumber.open(file_obj) as pdf:
-            pages_text = []
-            for page in pdf.pages:
-                t = page.extract_text()
-                if t:
-                    pages_text.append(t)
-        return "\n\n".join(pages_text).strip()
+        return extract_text_from_pdf(uploaded_file.getvalue(), max_pages)
     except Exception as e:
         st.error(f"Could not read PDF: {e}")
         return ""
 
-# ---- Helper: call Gemini to extract structured JSON ----
-def call_gemini_for_structure(text, doc_type="Document"):
-    """Ask Gemini to extract structured JSON from text."""
-    if not GEMINI_KEY:
-        return None, "No API key configured."
-
-    prompt = f"""
-You are a reliable document parser. Given the following {doc_type} text (may be multi-page, may contain tables),
-extract the following fields and return only valid JSON (no explanation):
+# ---- Response schema: Gemini is constrained to emit exactly this JSON shape ----
+class LineItem(TypedDict):
+    description: str
+    qty: float
+    unit_price: float
+    total: float
+
+class ParsedDocument(TypedDict):
+    document_type: str
+    number: str
+    vendor: str
+    date: str
+    grand_total: float
+    items: list[LineItem]
+
+class DocumentPair(TypedDict):
+    po: ParsedDocument
+    invoice: ParsedDocument
+
+# ---- Prompt: kept at module level so its text can version the Gemini disk cache ----
+PROMPT_TEMPLATE = """
+You are a reliable document parser. Given the following Purchase Order text and Invoice text (each may be multi-page,
+may contain tables), extract the following fields for EACH document:
 
 - document_type: "Purchase Order" or "Invoice"
 - number: document number (PO number or Invoice number)
@@ -54,39 +185,128 @@ extract the following fields and return only valid JSON (no explanation):
 - grand_total: grand total amount if present (numeric)
 - items: list of item objects, each with: description, qty (number), unit_price (number), total (number)
 
-Return result exactly as JSON. Example:
-{{ "document_type":"Purchase Order", "number":"PO-12345", "vendor":"ACME Ltd",
-  "date":"2024-03-01", "grand_total":"12345.67",
-  "items":[{{"description":"Bolt 10mm","qty":10,"unit_price":5.0,"total":50.0}}, ...] }}
-  
-Here is the {doc_type} text to analyze:
+Return the Purchase Order under "po" and the Invoice under "invoice".
 
-\"\"\"{text[:15000]}\"\"\"
-    """
+Here is the Purchase Order text to analyze:
+
+\"\"\"{po_text}\"\"\"
+
+Here is the Invoice text to analyze:
+
+\"\"\"{inv_text}\"\"\"
+"""
+
+def _schema_signature(tp):
+    """Stable string form of a (nested) TypedDict schema, e.g. {po:{...},invoice:{...}}."""
+    hints = getattr(tp, "__annotations__", None)
+    if hints is None:
+        args = getattr(tp, "__args__", ())
+        name = getattr(tp, "__name__", str(tp))
+        return name + ("[" + ",".join(_schema_signature(arg) for arg in args) + "]" if args else "")
+    return "{" + ",".join(f"{k}:{_schema_signature(v)}" for k, v in hints.items()) + "}"
+
+# Changes to the prompt or output schema produce new keys, so stale parses are never served
+GEMINI_CACHE_VERSION = content_hash(PROMPT_TEMPLATE + _schema_signature(DocumentPair))
+
+# ---- Helper: call Gemini to extract structured JSON for both documents ----
+def call_gemini_for_pair(po_text, inv_text):
+    """Ask Gemini to extract structured JSON for a PO and an Invoice in one request."""
+    if _MODEL is None:
+        return None, None, "No API key configured."
+
+    po_text = truncate_tokens(po_text)
+    inv_text = truncate_tokens(inv_text)
+    key = ("gemini_pair", MODEL_NAME, GEMINI_CACHE_VERSION, content_hash(po_text), content_hash(inv_text))
+    cached = cache.get(key)
+    if cached is not None:
+        po_struct, inv_struct = cached
+        return po_struct, inv_struct, None
+
+    prompt = PROMPT_TEMPLATE.format(po_text=po_text, inv_text=inv_text)
 
     try:
-        model = genai.GenerativeModel(MODEL_NAME)
-        response = model.generate_content(prompt)
-        raw = response.text.strip()
-
-        # Try to extract JSON substring
-        json_text = raw
-        # If there is extra text around JSON, try to find first { ... } block
-        if not (json_text.startswith("{") and json_text.endswith("}")):
-            m = re.search(r"(\{[\s\S]*\})", json_text)
-            if m:
-                json_text = m.group(1)
-
-        parsed = json.loads(json_text)
-        return parsed, None
-    except json.JSONDecodeError:
-        return None, f"AI returned invalid JSON. Raw response:\n{raw}"
+        # Several candidates for one prompt: input is billed once, and we keep the first that parses
+        response = _MODEL.generate_content(
+            prompt,
+            generation_config=genai.types.GenerationConfig(
+                candidate_count=3,
+                temperature=0.2,
+                response_mime_type="application/json",
+                response_schema=DocumentPair,
+            ),
+        )
     except Exception as e:
-        return None, f"Error calling Gemini: {e}"
-
-# ---- Helper: match two item descriptions (simple similarity) ----
-def similar(a, b):
-    return SequenceMatcher(None, a.lower().strip(), b.lower().strip()).ratio()
+        return None, None, f"Error calling Gemini: {e}"
+
+    raws = []
+    for candidate in response.candidates:
+        raw = "".join(getattr(part, "text", "") for part in candidate.content.parts).strip()
+        raws.append(raw)
+        try:
+            parsed = orjson.loads(raw)
+            po_struct, inv_struct = parsed.get("po"), parsed.get("invoice")
+        except (orjson.JSONDecodeError, json.JSONDecodeError, AttributeError):
+            continue
+        cache.set(key, (po_struct, inv_struct), expire=CACHE_TTL_SECONDS)
+        return po_struct, inv_struct, None
+
+    raw = raws[0] if raws else ""
+    return None, None, f"AI returned invalid JSON. Raw response:\n{raw}"
+
+# ---- Helper: normalize an item description for matching ----
+_WS_RE = re.compile(r"\s+")
+_CURRENCY_RE = re.compile(r"[$€£¥₹]")
+
+def normalize(desc):
+    """Lowercase, drop currency symbols and collapse whitespace."""
+    return _WS_RE.sub(" ", _CURRENCY_RE.sub("", str(desc or "").lower())).strip()
+
+# ---- Helper: pair PO items with invoice items ----
+def match_items(po_descs, inv_descs, threshold):
+    """Return {po_idx: (inv_idx, score)} for descriptions paired at or above threshold."""
+    matches = {}
+
+    # Exact pass: identical normalized descriptions pair directly with a dict lookup
+    po_by_key = {}
+    for po_idx, desc in enumerate(po_descs):
+        if desc:
+            po_by_key.setdefault(desc, []).append(po_idx)
+    inv_rest = []
+    for inv_idx, desc in enumerate(inv_descs):
+        candidates = po_by_key.get(desc)
+        if candidates:
+            matches[candidates.pop(0)] = (inv_idx, 1.0)
+        else:
+            inv_rest.append(inv_idx)
+    po_rest = [po_idx for po_idx in range(len(po_descs)) if po_idx not in matches]
+    if not po_rest or not inv_rest:
+        return matches
+
+    # Fuzzy pass over the residue only: one batched n x m score matrix
+    po_left = [po_descs[i] for i in po_rest]
+    inv_left = [inv_descs[j] for j in inv_rest]
+    scores = process.cdist(po_left, inv_left, scorer=fuzz.ratio, workers=-1,
+                           score_cutoff=threshold * 100) / 100.0
+    # Blank descriptions never match (fuzz.ratio("", "") is 100); same rule as the exact and token-set passes
+    scores[np.array([not d for d in po_left]), :] = 0.0
+    scores[:, np.array([not d for d in inv_left])] = 0.0
+    # Token-set overlap catches reordered descriptions that char-level ratio underrates
+    token_scores = token_set_scores(po_left, inv_left, score_cutoff=threshold)
+    scores = np.maximum(scores, token_scores)
+
+    # Optimal one-to-one assignment (Hungarian) instead of greedy best-per-row
+    row_ind, col_ind = linear_sum_assignment(-scores)
+    for r, c in zip(row_ind, col_ind):
+        if scores[r, c] >= threshold:
+            matches[po_rest[r]] = (inv_rest[c], float(scores[r, c]))
+    return matches
+
+# ---- Helper: numeric equality for amount fields ("200.00" == "200") ----
+def _num_eq(a, b):
+    try:
+        return Decimal(a) == Decimal(b)
+    except InvalidOperation:
+        return False
 
 # ---- Comparison logic ----
 def compare_structures(po_struct, inv_struct, item_match_threshold=0.7):
@@ -94,40 +314,32 @@ def compare_structures(po_struct, inv_struct, item_match_threshold=0.7):
 
     # Compare header-level fields
     header_checks = []
-    for field_label, po_key, inv_key in [
-        ("Document Number", "number", "number"),
-        ("Vendor", "vendor", "vendor"),
-        ("Date", "date", "date"),
-        ("Grand Total", "grand_total", "grand_total"),
+    # numeric: compare by value ("200.00" == "200"); identifiers and dates stay exact strings
+    for field_label, po_key, inv_key, numeric in [
+        ("Document Number", "number", "number", False),
+        ("Vendor", "vendor", "vendor", False),
+        ("Date", "date", "date", False),
+        ("Grand Total", "grand_total", "grand_total", True),
     ]:
         po_val = po_struct.get(po_key, "") if po_struct else ""
         inv_val = inv_struct.get(inv_key, "") if inv_struct else ""
-        status = "Match" if str(po_val).strip() and str(inv_val).strip() and str(po_val).strip() == str(inv_val).strip() else "Mismatch"
+        p, i = str(po_val).strip(), str(inv_val).strip()
+        status = "Match" if p and i and (p == i or (numeric and _num_eq(p, i))) else "Mismatch"
         header_checks.append((field_label, po_val, inv_val, status))
 
     # For items: match by best similarity of description
     po_items = po_struct.get("items", []) if po_struct else []
     inv_items = inv_struct.get("items", []) if inv_struct else []
-    inv_used = set()
-
-    for po_it in po_items:
-        best_match = None
-        best_score = 0.0
-        best_idx = None
-        for idx, inv_it in enumerate(inv_items):
-            if idx in inv_used:
-                continue
-            score = similar(po_it.get("description",""), inv_it.get("description",""))
-            if score > best_score:
-                best_score = score
-                best_match = inv_it
-                best_idx = idx
-
-        if best_score >= item_match_threshold:
-            inv_used.add(best_idx)
-            inv_it = best_match
-        else:
-            inv_it = None
+    # Normalize each description exactly once (n + m calls); the exact, ratio and
+    # token-set passes in match_items all reuse these lists instead of re-normalizing per pair
+    po_descs = [normalize(it.get("description", "")) for it in po_items]
+    inv_descs = [normalize(it.get("description", "")) for it in inv_items]
+    matches = match_items(po_descs, inv_descs, item_match_threshold)
+    inv_used = {inv_idx for inv_idx, _ in matches.values()}
+
+    for po_idx, po_it in enumerate(po_items):
+        best_idx, best_score = matches.get(po_idx, (None, 0.0))
+        inv_it = inv_items[best_idx] if best_idx is not None else None
 
         # Compare quantities/prices
         po_qty = po_it.get("qty", "")
@@ -177,6 +389,9 @@ def compare_structures(po_struct, inv_struct, item_match_threshold=0.7):
 # ---- UI ----
 st.sidebar.header("Options")
 threshold = st.sidebar.slider("Item match threshold (similarity)", 50, 95, 70) / 100.0
+# PO / invoice content is almost always up front; skip attached T&Cs unless asked
+extract_all_pages = st.sidebar.checkbox("Extract all pages", value=False)
+max_pages = None if extract_all_pages else st.sidebar.slider("Max pages to extract", 1, 20, 5)
 
 col1, col2 = st.columns(2)
 with col1:
@@ -189,21 +404,19 @@ if st.button("Compare PO ↔ Invoice"):
         st.error("Upload both PO and Invoice PDFs.")
     else:
         with st.spinner("Extracting text from PDFs..."):
-            po_text = extract_text_from_pdf(po_file)
-            inv_text = extract_text_from_pdf(inv_file)
+            po_text = read_uploaded_pdf(po_file, max_pages)
+            inv_text = read_uploaded_pdf(inv_file, max_pages)
 
         st.subheader("Raw extracted text (first 4000 chars)")
         st.code(po_text[:4000], language="text")
         st.code(inv_text[:4000], language="text")
 
         with st.spinner("Calling Gemini to parse documents..."):
-            po_struct, po_err = call_gemini_for_structure(po_text, "Purchase Order")
-            inv_struct, inv_err = call_gemini_for_structure(inv_text, "Invoice")
+            # One request for both documents: shared prompt, single round-trip
+            po_struct, inv_struct, parse_err = call_gemini_for_pair(po_text, inv_text)
 
-        if po_err:
-            st.error(f"PO parsing error: {po_err}")
-        if inv_err:
-            st.error(f"Invoice parsing error: {inv_err}")
+        if parse_err:
+            st.error(f"Parsing error: {parse_err}")
 
         st.subheader("AI Parsed JSON (PO)")
         st.json(po_struct if po_struct else {})
@@ -221,7 +434,8 @@ if st.button("Compare PO ↔ Invoice"):
                 return "background-color: #d4f7dc"  # green
             else:
                 return "background-color: #f7d4d4"  # red
-        st.dataframe(header_df.style.applymap(lambda v: "background-color: #d4f7dc" if v=="Match" else "", subset=pd.IndexSlice[:, ["Status"]]), use_container_width=True)
+        header_styles = np.where(header_df["Status"].to_numpy() == "Match", "background-color: #d4f7dc", "")
+        st.dataframe(header_df.style.apply(lambda col: header_styles, subset=["Status"]), use_container_width=True)
 
         st.subheader("Line Item Comparison (side-by-side)")
         # Build display table rows
@@ -240,10 +454,11 @@ if st.button("Compare PO ↔ Invoice"):
                 "Match Score": r["match_score"]
             })
         df_items = pd.DataFrame(display_rows)
-        # style: color Status column
-        def status_color(val):
-            return 'background-color: #d4f7dc' if val == "Match" else 'background-color: #f7d4d4'
-        st.dataframe(df_items.style.applymap(lambda v: status_color(v) if v in ["Match","Mismatch"] else "", subset=["Status"]), use_container_width=True)
+        # style: color Status column, computed once as a column mask instead of per cell
+        status = df_items["Status"].to_numpy()
+        item_styles = np.where(status == "Match", "background-color: #d4f7dc",
+                               np.where(status == "Mismatch", "background-color: #f7d4d4", ""))
+        st.dataframe(df_items.style.apply(lambda col: item_styles, subset=["Status"]), use_container_width=True)
 
         st.success("Comparison complete.")
 
@@ -251,4 +466,4 @@ if st.button("Clear"):
     st.experimental_rerun()
 
 st.markdown("---")
-st.caption("Notes: Uses pdfplumber to pull text then Gemini to parse structure. If Gemini returns invalid JSON, check raw response and adjust prompt or increase text chunking.")
+st.caption("Notes: Uses PyMuPDF (pdfplumber as fallback) to pull text then Gemini to parse structure. If Gemini returns invalid JSON, check raw response and adjust prompt or increase text chunking.")
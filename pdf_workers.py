@@ -0,0 +1,43 @@
+"""pdfplumber page-range extraction for the PDF text fallback in app.py.
+
+Parallel extraction runs in a separate helper process (``python pdf_workers.py PATH N_PAGES WORKERS``)
+rather than inside the Streamlit server: forking the server (Tornado, gRPC and Numba threads) can hang,
+and spawn workers started from the server would re-execute the whole app script as ``__mp_main__``.
+From this helper, spawn workers only re-import this small module.
+"""
+import io
+import sys
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import pdfplumber
+
+
+def extract_page_range(path, start, end):
+    """Return joined text of pages start..end-1 (1-based) of the PDF at path."""
+    # Write pages straight into one buffer instead of holding a list plus the joined copy
+    buf = io.StringIO()
+    with pdfplumber.open(path, pages=list(range(start, end))) as pdf:
+        for page in pdf.pages:
+            t = page.extract_text()
+            if t:
+                if buf.tell():
+                    buf.write("\n\n")
+                buf.write(t)
+    return buf.getvalue()
+
+
+def extract_pages_parallel(path, n_pages, workers):
+    """Split pages 1..n_pages into contiguous ranges, one per spawn worker, and join them in page order."""
+    step = -(-n_pages // workers)
+    starts = list(range(1, n_pages + 1, step))
+    ends = [min(start + step, n_pages + 1) for start in starts]
+    with ProcessPoolExecutor(max_workers=len(starts), mp_context=multiprocessing.get_context("spawn")) as ex:
+        parts = ex.map(extract_page_range, [path] * len(starts), starts, ends)
+        return "\n\n".join(part for part in parts if part)
+
+
+if __name__ == "__main__":
+    path, n_pages, workers = sys.argv[1], int(sys.argv[2]), int(sys.argv[3])
+    sys.stdout.reconfigure(encoding="utf-8")
+    sys.stdout.write(extract_pages_parallel(path, n_pages, workers))
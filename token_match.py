@@ -0,0 +1,64 @@
+"""Token-set (Jaccard) similarity for line-item descriptions, used by match_items in app.py.
+
+Kept out of the Streamlit script so the Numba dispatcher is built once per process instead of on every rerun.
+The kernel is deliberately serial: Streamlit calls it from one thread per session, Numba's workqueue threading
+layer aborts on concurrent parallel calls, and the residual matrices are only a few dozen rows.
+"""
+import re
+
+import numpy as np
+from numba import njit
+
+
+_TOKEN_RE = re.compile(r"\w+")
+
+
+def encode_token_sets(descs, vocab):
+    """Encode each description as a sorted set of int32 token ids, CSR-style (offsets, ids)."""
+    offsets = [0]
+    ids = []
+    for desc in descs:
+        token_ids = sorted({vocab.setdefault(tok, len(vocab)) for tok in _TOKEN_RE.findall(desc)})
+        ids.extend(token_ids)
+        offsets.append(len(ids))
+    return np.array(offsets, dtype=np.int64), np.array(ids, dtype=np.int32)
+
+
+@njit(cache=True)
+def _jaccard_matrix(a_off, a_ids, b_off, b_ids, cutoff):
+    n = len(a_off) - 1
+    m = len(b_off) - 1
+    out = np.zeros((n, m), dtype=np.float32)
+    for i in range(n):
+        a0, a1 = a_off[i], a_off[i + 1]
+        for j in range(m):
+            b0, b1 = b_off[j], b_off[j + 1]
+            la, lb = a1 - a0, b1 - b0
+            if la == 0 or lb == 0:
+                continue
+            # Cheap upper bound (like SequenceMatcher.real_quick_ratio): skip the merge if it can't reach cutoff
+            if min(la, lb) / max(la, lb) < cutoff:
+                continue
+            # Two-pointer merge over the sorted id runs
+            p, q, inter = a0, b0, 0
+            while p < a1 and q < b1:
+                if a_ids[p] == b_ids[q]:
+                    inter += 1
+                    p += 1
+                    q += 1
+                elif a_ids[p] < b_ids[q]:
+                    p += 1
+                else:
+                    q += 1
+            score = inter / (la + lb - inter)
+            if score >= cutoff:
+                out[i, j] = score
+    return out
+
+
+def token_set_scores(po_descs, inv_descs, score_cutoff=0.0):
+    """Return an n x m matrix of |A∩B| / |A∪B| over description token sets; scores below score_cutoff are 0."""
+    vocab = {}
+    a_off, a_ids = encode_token_sets(po_descs, vocab)
+    b_off, b_ids = encode_token_sets(inv_descs, vocab)
+    return _jaccard_matrix(a_off, a_ids, b_off, b_ids, score_cutoff)